@@ -0,0 +1,14 @@
+import threading
+
+# streamlit re-executes the app script on every rerun, so process wide state has to live in an imported module
+_lock = threading.Lock()
+
+
+def start_once(name, target):
+    # start target in a daemon thread unless a thread of that name already runs in this process,
+    # looking the thread up by name also holds when streamlit reloads this module
+    with _lock:
+        if any(thread.name == name for thread in threading.enumerate()):
+            return False
+        threading.Thread(target=target, name=name, daemon=True).start()
+        return True
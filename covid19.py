@@ -1,10 +1,18 @@
+import io
 import os
+import shutil
+import subprocess
+import sys
+import time
 from functools import reduce
 
+# altair and pydeck are imported by the views using them to keep the cold start short
 import streamlit as st
+import streamlit.components.v1 as components
+import numpy as np
 import pandas as pd
-import altair as alt
-import pydeck as pdk
+
+from background import start_once
 
 # data from Johns Hopkins University (https://github.com/CSSEGISandData/COVID-19)
 BASEURL = 'https://raw.githubusercontent.com/CSSEGISandData/' \
@@ -17,8 +25,51 @@ st.set_page_config(  # Alternate names: setup_page, page, layout
     page_icon=None,  # String, anything supported by st.image, or None.
 )
 
-@st.cache
-def get_data():
+# rows per page offered in the raw data table
+PAGE_SIZES = [25, 50, 100, 250]
+# page rendering a serialized Vega-Lite spec, sent to the client without encoding it again
+VEGA_EMBED_HTML = '''
+<div id="chart" style="width: 100%;"></div>
+<script src="https://cdn.jsdelivr.net/npm/vega@5"></script>
+<script src="https://cdn.jsdelivr.net/npm/vega-lite@{version}"></script>
+<script src="https://cdn.jsdelivr.net/npm/vega-embed@6"></script>
+<script>vegaEmbed('#chart', {spec}, {{actions: false}});</script>
+'''
+CHART_HEIGHT = 340
+# upper bound of cached results per view, so option combinations do not pile up for the life of the server
+MAX_CACHED_VIEWS = 64
+
+# number of recent days used to fit the projection models
+FIT_WINDOW = 21
+# candidate final sizes of the logistic model as multiples of the latest count
+CAPACITY_GRID = np.geomspace(1.05, 20.0, 64)
+
+# size in degrees of the grid cells used to index the map points
+GRID_CELL = 2.0
+GRID_ROWS = int(180 / GRID_CELL)
+GRID_COLS = int(360 / GRID_CELL)
+EARTH_RADIUS_KM = 6371.0
+# assumed size of the map in pixels, used to derive the visible bounds from center and zoom
+MAP_WIDTH, MAP_HEIGHT = 1400, 600
+# the loaded area is this many times the assumed map size, zooming out beyond the selected zoom is locked
+VIEWPORT_PADDING = 2.0
+# number of neighbours listed for the centred region and of search matches offered
+NUM_NEAREST = 10
+MAX_SEARCH_MATCHES = 25
+
+# downloaded data snapshots, one directory per version
+SNAPSHOT_DIR = os.environ.get('COVID19_SNAPSHOT_DIR', '/tmp/covid19-data')
+DATA_FRAMES = ['confirmed', 'deaths', 'recovered', 'confirmed_us', 'deaths_us']
+# holds the version of the latest snapshot, rewritten after every successful refresh, used as readiness signal
+READY_FILE = os.environ.get('COVID19_READY_FILE', '/tmp/covid19.ready')
+# seconds between background refreshes, the source data is updated once a day
+REFRESH_INTERVAL = 6 * 60 * 60
+REFRESH_THREAD = 'covid19-data-refresh'
+# modules whose cold import time is measured by the benchmark
+HEAVY_MODULES = ['streamlit', 'numpy', 'pandas', 'altair', 'pydeck']
+
+
+def download_data():
     url_confirmed = os.path.join(BASEURL, 'time_series_covid19_confirmed_global.csv')
     url_deaths = os.path.join(BASEURL, 'time_series_covid19_deaths_global.csv')
     url_recovered = os.path.join(BASEURL, 'time_series_covid19_recovered_global.csv')
@@ -36,7 +87,78 @@ def get_data():
     return confirmed_raw.dropna(), deaths_raw.dropna(), recovered_raw.dropna(), confirmed_us_raw.dropna(), deaths_us_raw.dropna()
 
 
-@st.cache
+@st.cache(max_entries=2, show_spinner=False)
+def get_data(data_version):
+    snapshot = os.path.join(SNAPSHOT_DIR, data_version)
+    return tuple(pd.read_parquet(os.path.join(snapshot, f'{name}.parquet')) for name in DATA_FRAMES)
+
+
+def read_data_version():
+    # version of the latest published snapshot, None before the first refresh
+    try:
+        with open(READY_FILE) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def refresh_data(warm_caches=False):
+    # download a new snapshot and publish it, the server also fills its data caches before publishing
+    data_version = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+    snapshot = os.path.join(SNAPSHOT_DIR, data_version)
+    os.makedirs(snapshot, exist_ok=True)
+    for name, df in zip(DATA_FRAMES, download_data()):
+        df.to_parquet(os.path.join(snapshot, f'{name}.parquet'))
+
+    if warm_caches:
+        confirmed_raw, deaths_raw, recovered_raw, confirmed_us_raw, deaths_us_raw = get_data(data_version)
+        preprocess_plot_data(confirmed_raw, deaths_raw, recovered_raw)
+        preprocess_map_data(confirmed_raw, deaths_raw, recovered_raw, confirmed_us_raw, deaths_us_raw)
+
+    # replace the ready file atomically, so readers never see a partial version
+    with open(READY_FILE + '.tmp', 'w') as f:
+        f.write(data_version)
+    os.replace(READY_FILE + '.tmp', READY_FILE)
+
+    # keep the previous snapshot for sessions still reading it
+    for old_version in sorted(os.listdir(SNAPSHOT_DIR))[:-2]:
+        shutil.rmtree(os.path.join(SNAPSHOT_DIR, old_version), ignore_errors=True)
+    return data_version
+
+
+def refresh_periodically():
+    while True:
+        time.sleep(REFRESH_INTERVAL)
+        try:
+            refresh_data(warm_caches=True)
+        except Exception as e:
+            # keep serving the last snapshot, the ready file ages and fails the health check
+            print(f'Data refresh failed: {e}', file=sys.stderr)
+
+
+def process_uptime():
+    # seconds since this process started, only available on linux
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+
+
+def measure_cold_imports():
+    # import time of each heavy module in a fresh interpreter, as paid by a cold server start
+    timings = {}
+    for module in HEAVY_MODULES:
+        code = f'import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)'
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+        timings[module] = float(result.stdout)
+    return timings
+
+
+@st.cache(max_entries=2)
 def preprocess_plot_data(confirmed_raw, deaths_raw, recovered_raw):
     # use numeric index and drop unused columns
     confirmed_raw = confirmed_raw.reset_index()
@@ -59,7 +181,7 @@ def preprocess_plot_data(confirmed_raw, deaths_raw, recovered_raw):
     return confirmed, deaths, recovered, date_list
 
 
-@st.cache
+@st.cache(max_entries=2)
 def preprocess_map_data(confirmed_raw, deaths_raw, recovered_raw, confirmed_us_raw, deaths_us_raw):
     # use numeric index and drop unused columns
     confirmed_raw = confirmed_raw.reset_index()
@@ -99,7 +221,6 @@ def preprocess_map_data(confirmed_raw, deaths_raw, recovered_raw, confirmed_us_r
 
     return confirmed_raw, deaths_raw, recovered_raw, date_list
 
-@st.cache
 def map_digest_format(df, date):
     map_format = df.copy()
     map_format['data'] = map_format[date]
@@ -108,7 +229,374 @@ def map_digest_format(df, date):
     return map_format
 
 
+@st.cache(hash_funcs={pd.DataFrame: lambda _: None}, allow_output_mutation=True, max_entries=MAX_CACHED_VIEWS)
+def sort_table(df, data_version, data_source, sort_by, ascending):
+    # sort once per column and direction, paging afterwards only slices the cached frame
+    return df.sort_values(sort_by, ascending=ascending, kind='mergesort').reset_index(drop=True)
+
+
+@st.cache(hash_funcs={pd.DataFrame: lambda _: None}, allow_output_mutation=True, max_entries=MAX_CACHED_VIEWS)
+def query_table(df, data_version, data_source, regions, sort_by, ascending, date_columns):
+    # keyed by data version and query, so a page flip never hashes the frames
+    table = sort_table(df, data_version, data_source, sort_by, ascending)
+    if regions:
+        table = table[table['Country/Region'].isin(regions)]
+    return table[['Country/Region'] + list(date_columns)].reset_index(drop=True)
+
+
+def export_table(table, file_format):
+    # serialize the whole query result, not only the visible page
+    if file_format == 'Parquet':
+        buffer = io.BytesIO()
+        table.to_parquet(buffer, index=False)
+        return buffer.getvalue()
+    return table.to_csv(index=False).encode('utf-8')
+
+
+def fit_log_linear(values, window):
+    # least squares fit of log counts for all regions at once, one column per region
+    y = np.log1p(values[:, -window:])
+    x = np.arange(window)
+    slope, intercept = np.polyfit(x, y.T, 1)
+    sigma = (y - (intercept[:, None] + slope[:, None] * x)).std(axis=1)
+    return slope, intercept, sigma
+
+
+def fit_logistic(values, window):
+    # C(t) = K / (1 + exp(a + b * t)) is linear in t as log(K / C - 1) for a fixed final size K,
+    # so every region is fitted for every K on the grid at once and the best K is kept
+    y = np.maximum(values[:, -window:], 1.0)
+    x = np.arange(window)
+    x_centered = x - x.mean()
+    capacity = y.max(axis=1, keepdims=True) * CAPACITY_GRID  # regions x grid
+    z = np.log(capacity[:, :, None] / y[:, None, :] - 1.0)  # regions x grid x days
+    slope = (z - z.mean(axis=2, keepdims=True)) @ x_centered / (x_centered @ x_centered)
+    intercept = z.mean(axis=2) - slope * x.mean()
+    fitted = capacity[:, :, None] / (1.0 + np.exp(intercept[:, :, None] + slope[:, :, None] * x))
+    residual = fitted - y[:, None, :]
+    best = (residual ** 2).sum(axis=2).argmin(axis=1)
+    rows = np.arange(len(y))
+    sigma = residual[rows, best].std(axis=1)
+    return capacity[rows, best], slope[rows, best], intercept[rows, best], sigma
+
+
+def project_values(values, last_date, model, horizon):
+    # fit all regions and return the projection band as regions x days arrays
+    x = np.arange(FIT_WINDOW, FIT_WINDOW + horizon)
+    if model == 'Log-Linear':
+        slope, intercept, sigma = fit_log_linear(values, FIT_WINDOW)
+        center = intercept[:, None] + slope[:, None] * x
+        lower = np.expm1(center - 2 * sigma[:, None])
+        mid = np.expm1(center)
+        upper = np.expm1(center + 2 * sigma[:, None])
+    else:
+        capacity, slope, intercept, sigma = fit_logistic(values, FIT_WINDOW)
+        mid = capacity[:, None] / (1.0 + np.exp(intercept[:, None] + slope[:, None] * x))
+        lower = mid - 2 * sigma[:, None]
+        upper = mid + 2 * sigma[:, None]
+
+    # cumulative counts can not drop below the latest observation, regions without cases stay at zero
+    latest = values[:, -1:]
+    no_cases = values[:, -FIT_WINDOW:].max(axis=1) <= 0
+    lower, mid, upper = (np.where(no_cases[:, None], latest, np.maximum(band, latest)) for band in (lower, mid, upper))
+    dates = pd.date_range(pd.to_datetime(last_date) + pd.Timedelta(days=1), periods=horizon)
+    return dates, lower, mid, upper
+
+
+@st.cache(hash_funcs={pd.DataFrame: lambda _: None}, max_entries=MAX_CACHED_VIEWS)
+def project(df, data_version, model, horizon):
+    # the fit covers every region, selecting another region only indexes the cached result
+    start = time.perf_counter()
+    values = df.drop(columns='Country/Region').to_numpy(dtype=float)
+    dates, lower, mid, upper = project_values(values, df.columns[-1], model, horizon)
+    return dates, lower, mid, upper, time.perf_counter() - start
+
+
+def grid_cell(latitude, longitude):
+    row = np.clip(np.floor((latitude + 90) / GRID_CELL), 0, GRID_ROWS - 1).astype(int)
+    col = np.clip(np.floor((longitude + 180) / GRID_CELL), 0, GRID_COLS - 1).astype(int)
+    return row, col
+
+
+@st.cache(hash_funcs={pd.DataFrame: lambda _: None}, allow_output_mutation=True, max_entries=6)
+def build_spatial_index(df, data_version, data_source):
+    # sort the points by grid cell so every row of cells maps to one contiguous slice,
+    # keyed by data version and source so reruns never hash the frame
+    start = time.perf_counter()
+    latitude = df['Lat'].to_numpy(dtype=float)
+    longitude = df['Long'].to_numpy(dtype=float)
+    valid = np.isfinite(latitude) & np.isfinite(longitude)
+    row, col = grid_cell(np.where(valid, latitude, 0.0), np.where(valid, longitude, 0.0))
+    # points without coordinates go to a trailing cell that is never queried
+    cells = np.where(valid, row * GRID_COLS + col, GRID_ROWS * GRID_COLS)
+    order = np.argsort(cells, kind='stable')
+    cell_starts = np.searchsorted(cells[order], np.arange(GRID_ROWS * GRID_COLS + 2))
+    index = (latitude, longitude, order, cell_starts)
+    return index, time.perf_counter() - start
+
+
+def query_viewport(index, south, west, north, east):
+    # positions of all points inside the bounds, west > east means the bounds cross the antimeridian
+    latitude, longitude, order, cell_starts = index
+    south, north = max(south, -90.0), min(north, 90.0)
+    (row_south, row_north), (col_west, col_east) = grid_cell(np.array([south, north]), np.array([west, east]))
+    if west <= east:
+        col_ranges = [(col_west, col_east)]
+    elif col_west <= col_east:
+        # both ends of a box spanning almost the whole globe fall into the same cells, scan every column once
+        col_ranges = [(0, GRID_COLS - 1)]
+    else:
+        col_ranges = [(col_west, GRID_COLS - 1), (0, col_east)]
+
+    candidates = [order[cell_starts[row * GRID_COLS + first]:cell_starts[row * GRID_COLS + last + 1]]
+                  for row in range(row_south, row_north + 1) for first, last in col_ranges]
+    candidates = np.concatenate(candidates)
+
+    lat, long = latitude[candidates], longitude[candidates]
+    inside = (lat >= south) & (lat <= north)
+    if west <= east:
+        inside &= (long >= west) & (long <= east)
+    else:
+        inside &= (long >= west) | (long <= east)
+    return np.sort(candidates[inside])
+
+
+def wrap_longitude(longitude):
+    return (longitude + 180.0) % 360.0 - 180.0
+
+
+def degree_box(latitude, longitude, half_height, half_width):
+    # (south, west, north, east) around a point, the whole longitude range if the box wraps around
+    if half_width >= 180.0:
+        return latitude - half_height, -180.0, latitude + half_height, 180.0
+    return latitude - half_height, wrap_longitude(longitude - half_width), \
+        latitude + half_height, wrap_longitude(longitude + half_width)
+
+
+def viewport_bounds(latitude, longitude, zoom):
+    # web mercator shows 360 degrees on 512 pixels at zoom 0
+    degrees_per_pixel = 360.0 / (512 * 2 ** zoom)
+    half_width = VIEWPORT_PADDING * MAP_WIDTH / 2 * degrees_per_pixel
+    half_height = VIEWPORT_PADDING * MAP_HEIGHT / 2 * degrees_per_pixel * np.cos(np.radians(latitude))
+    return degree_box(latitude, longitude, half_height, half_width)
+
+
+def haversine(latitude, longitude, latitudes, longitudes):
+    lat1, lon1, lat2, lon2 = map(np.radians, (latitude, longitude, latitudes, longitudes))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+@st.cache(hash_funcs={pd.DataFrame: lambda _: None}, allow_output_mutation=True, max_entries=6)
+def location_names(points_df, data_version, data_source):
+    return sorted(points_df['Combined_Key'].dropna().unique())
+
+
+def search_locations(points_df, data_version, data_source, search):
+    # case insensitive substring match over the region names of the current data source
+    search = search.strip().lower()
+    if not search:
+        return []
+    names = location_names(points_df, data_version, data_source)
+    return [name for name in names if search in name.lower()][:MAX_SEARCH_MATCHES]
+
+
+def query_nearest(index, latitude, longitude, k):
+    # grow the search box until it holds k points, then widen it to the k-th distance so no closer point is missed
+    points_latitude, points_longitude = index[0], index[1]
+    half_height = GRID_CELL
+    while True:
+        candidates = query_viewport(index, *degree_box(latitude, longitude, half_height, half_height))
+        if len(candidates) >= k or half_height >= 180.0:
+            break
+        half_height *= 2
+
+    distance = haversine(latitude, longitude, points_latitude[candidates], points_longitude[candidates])
+    if len(candidates) >= k:
+        half_height = np.degrees(np.sort(distance)[k - 1] / EARTH_RADIUS_KM)
+        cos_latitude = np.cos(np.radians(min(abs(latitude) + half_height, 90.0)))
+        half_width = half_height / cos_latitude if cos_latitude > 1e-6 else 180.0
+        candidates = query_viewport(index, *degree_box(latitude, longitude, half_height, half_width))
+        distance = haversine(latitude, longitude, points_latitude[candidates], points_longitude[candidates])
+
+    nearest = np.argsort(distance, kind='stable')[:k]
+    return candidates[nearest], distance[nearest]
+
+
+@st.cache(hash_funcs={pd.DataFrame: lambda _: None}, allow_output_mutation=True, show_spinner=False,
+          max_entries=MAX_CACHED_VIEWS)
+def region_chart_spec(confirmed, deaths, recovered, data_version, selection, model=None, horizon=None,
+                      projection_df=None):
+    # the serialized Vega-Lite page is keyed by data version and display options, the frames are not hashed
+    import altair as alt
+
+    start = time.perf_counter()
+    df_dict = {'confirmed': confirmed, 'recovered': recovered, 'deaths': deaths}
+    region = confirmed['Country/Region']
+
+    # iterate over all three dfs and prepare for plot
+    for name, _ in df_dict.items():
+        df_dict[name] = df_dict[name][region == selection].drop(columns='Country/Region')
+        df_dict[name] = pd.melt(df_dict[name])
+        df_dict[name]['date'] = pd.to_datetime(df_dict[name].variable, infer_datetime_format=True)
+        df_dict[name] = df_dict[name].set_index('date')
+        df_dict[name] = df_dict[name][['value']]
+        df_dict[name].columns = [name]
+
+    df = reduce(lambda a, b: pd.merge(a, b, on='date'), list(df_dict.values()))
+    df['confirmed_active'] = df.confirmed - (df.deaths + df.recovered)
+
+    plot_columns = ['recovered', 'confirmed_active', 'deaths']
+    colors = ['forestgreen', 'gold', 'red']
+
+    color_scale = alt.Scale(domain=plot_columns, range=colors)
+
+    plot_df = pd.melt(df.reset_index(), id_vars=['date'], value_vars=plot_columns)
+
+    # prevent altair from sorting the variables (deaths should be lowest)
+    plot_df['order'] = plot_df['variable'].replace({val: idx for idx, val in enumerate(plot_columns[::-1])})
+
+    altair_plot = alt.Chart(plot_df.reset_index()).mark_bar().properties(height=300).encode(
+        x=alt.X('date:T', title='Date'),
+        y=alt.Y('sum(value):Q', title='Count', scale=alt.Scale(type='linear')),
+        color=alt.Color('variable:N', title='', scale=color_scale),
+        order='order'
+    )
+
+    if projection_df is not None:
+        band = alt.Chart(projection_df).mark_area(opacity=0.3, color='steelblue').encode(
+            x='date:T',
+            y='lower:Q',
+            y2='upper:Q'
+        )
+        line = alt.Chart(projection_df).mark_line(color='steelblue').encode(
+            x='date:T',
+            y='projection:Q'
+        )
+        altair_plot = altair_plot + band + line
+
+    altair_plot = altair_plot.properties(width='container')
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    # escape closing tags, the spec is embedded in a script element
+    spec = altair_plot.to_json().replace('</', '<\\/')
+    html = VEGA_EMBED_HTML.format(version=alt.SCHEMA_VERSION.lstrip('v'), spec=spec)
+    return {'html': html, 'build_time': build_time, 'encode_time': time.perf_counter() - start, 'served': 0}
+
+
+@st.cache(hash_funcs={pd.DataFrame: lambda _: None, np.ndarray: lambda _: None},
+          allow_output_mutation=True, show_spinner=False, max_entries=MAX_CACHED_VIEWS)
+def map_deck(points_df, visible, data_version, data_source, date, latitude, longitude, zoom, min_zoom, intensity):
+    # the serialized deck is keyed by data version, date and viewport, the frame and visible points are not hashed
+    start = time.perf_counter()
+    map_df = map_digest_format(points_df.iloc[visible][['Lat', 'Long', 'Combined_Key', date]], date)
+    deck = build_deck(map_df, latitude, longitude, zoom, min_zoom, intensity)
+    build_time = time.perf_counter() - start
+
+    # st.pydeck_chart encodes the deck through to_json on every rerun, so hand it the cached JSON instead
+    start = time.perf_counter()
+    spec = deck.to_json()
+    deck.to_json = lambda: spec
+    return {'deck': deck, 'build_time': build_time, 'encode_time': time.perf_counter() - start, 'served': 0}
+
+
+def build_deck(map_df, latitude, longitude, zoom, min_zoom, intensity):
+    import pydeck as pdk
+
+    return pdk.Deck(
+        map_style='mapbox://styles/mapbox/dark-v9',
+        tooltip={'text': '{Combined_Key}: {data_string}'},
+        initial_view_state=pdk.ViewState(
+            latitude=latitude,
+            longitude=longitude,
+            zoom=zoom,
+            min_zoom=min_zoom,
+            pitch=0,
+        ),
+        layers=[
+            pdk.Layer(
+                'HeatmapLayer',
+                data=map_df,
+                get_position='[Long, Lat]',
+                opacity=1.0,
+                aggregation='"MEAN"',
+                get_weight='[data]',
+                radius_pixels=intensity,
+                threshold=0.002,
+                pickable=True
+            ),
+            pdk.Layer(
+                'ScatterplotLayer',
+                data=map_df,
+                get_position='[Long, Lat]',
+                pickable=True,
+                opacity=0.99,
+                stroked=True,
+                filled=True,
+                radius_scale=20,
+                radius_min_pixels=20,
+                radius_max_pixels=100,
+                line_width_min_pixels=1,
+                get_radius='exits_radius',
+                get_fill_color=[0, 0, 0, 0.0],
+                get_line_color=[0, 0, 0, 0.0],
+            )
+        ],
+    )
+
+
+def serve_cached(entry):
+    # cached entries count how often they were served, only the first serve after the build is a miss
+    hit = entry['served'] > 0
+    entry['served'] += 1
+    return hit
+
+
+def report_cached(performance, name, entry, hit):
+    if hit:
+        performance.text(f'{name}: cache hit, saved {entry["encode_time"] * 1000:.2f} ms serialization '
+                         f'and {entry["build_time"] * 1000:.2f} ms construction')
+    else:
+        performance.text(f'{name}: cache miss, built in {entry["build_time"] * 1000:.2f} ms, '
+                         f'serialized in {entry["encode_time"] * 1000:.2f} ms')
+
+
+def warm_up():
+    # run `python covid19.py --warm-up` before starting the server, the ready file is only present once it succeeded
+    if os.path.exists(READY_FILE):
+        os.remove(READY_FILE)
+
+    data_version = refresh_data()
+    # the warm-up is the first process of a deployment, so its uptime is the time from start to readiness
+    time_to_ready = process_uptime()
+    if time_to_ready is not None:
+        print(f'Data version {data_version} ready after {time_to_ready:.2f} s')
+
+
+def benchmark():
+    # run `python covid19.py --benchmark` to measure the cold start and a full projection refit
+    for module, import_time in measure_cold_imports().items():
+        print(f'Cold import of {module}: {import_time * 1000:.2f} ms')
+
+    start = time.perf_counter()
+    data_version = read_data_version() or refresh_data()
+    confirmed_raw, deaths_raw, recovered_raw, confirmed_us_raw, deaths_us_raw = get_data(data_version)
+    preprocess_plot_data(confirmed_raw, deaths_raw, recovered_raw)
+    preprocess_map_data(confirmed_raw, deaths_raw, recovered_raw, confirmed_us_raw, deaths_us_raw)
+    print(f'Data loading and preprocessing: {(time.perf_counter() - start) * 1000:.2f} ms')
+
+    # a full refit of the county level series has to fit into a refresh cycle
+    date_list = confirmed_raw.columns[3:]
+    county_values = confirmed_us_raw[confirmed_us_raw.columns.intersection(date_list)].to_numpy(dtype=float)
+    for model in ['Log-Linear', 'Logistic']:
+        start = time.perf_counter()
+        project_values(county_values, date_list[-1], model, horizon=28)
+        print(f'{model} refit of {len(county_values):,} county series: {(time.perf_counter() - start) * 1000:.2f} ms')
+
+
 def main():
+    run_start = time.perf_counter()
     st.title('COVID-19 Data Explorer')
     st.markdown(
         """
@@ -117,7 +605,12 @@ def main():
         """
     )
 
-    confirmed_raw, deaths_raw, recovered_raw, confirmed_us_raw, deaths_us_raw = get_data()
+    # one refresh thread per server process, it survives reruns, cache clearing and code reloads
+    start_once(REFRESH_THREAD, refresh_periodically)
+
+    # sessions read the latest published snapshot, without a warm-up the first session downloads it
+    data_version = read_data_version() or refresh_data()
+    confirmed_raw, deaths_raw, recovered_raw, confirmed_us_raw, deaths_us_raw = get_data(data_version)
     confirmed, deaths, recovered, date_list = preprocess_plot_data(confirmed_raw, deaths_raw, recovered_raw)
 
     view = st.sidebar.selectbox('Choose View', ['Raw Data', 'Data Visualization', 'World Map'], index=2)
@@ -134,17 +627,49 @@ def main():
     st.sidebar.success(f'Recovered: {total_recovered:,}')
     st.sidebar.info(f'Confirmed: {total_confirmed:,}')
 
+    # timings of the current rerun
+    performance = st.sidebar.expander('Performance')
+
     if view == 'Raw Data':
 
-        # show the dataframes in the app
-        st.markdown('### Confirmed Cases:')
-        st.dataframe(confirmed)
+        df_dict = {'Confirmed Cases': confirmed, 'COVID-19 Related Deaths': deaths, 'Recovered Cases': recovered}
 
-        st.markdown('### COVID-19 Related Deaths:')
-        st.dataframe(deaths)
+        data_source = st.selectbox('Select Data Source:', list(df_dict.keys()))
+        df = df_dict[data_source]
 
-        st.markdown('### Recovered Cases:')
-        st.dataframe(recovered)
+        regions = st.multiselect('Filter Regions:', list(df['Country/Region']))
+
+        # only a window of date columns is sent to the browser, default is the last two weeks
+        num_days = len(date_list)
+        first_day, last_day = st.slider('Date Window:', min_value=0, max_value=num_days - 1,
+                                        value=(max(num_days - 14, 0), num_days - 1), format='Day %i')
+        date_columns = date_list[first_day:last_day + 1]
+
+        sort_by = st.selectbox('Sort By:', ['Country/Region'] + list(date_columns[::-1]))
+        ascending = st.checkbox('Ascending', value=sort_by == 'Country/Region')
+
+        table = query_table(df, data_version, data_source, tuple(regions), sort_by, ascending, tuple(date_columns))
+
+        page_size = st.sidebar.selectbox('Rows per Page', PAGE_SIZES, index=0)
+        num_pages = max((len(table) - 1) // page_size + 1, 1)
+        page = st.number_input(f'Page (of {num_pages}):', min_value=1, max_value=num_pages, value=1, step=1)
+
+        # show only the current page of the query in the app
+        start = (int(page) - 1) * page_size
+        st.markdown(f'### {data_source}:')
+        st.text(f'Rows {min(start + 1, len(table))}-{min(start + page_size, len(table))} of {len(table)}')
+        st.dataframe(table.iloc[start:start + page_size])
+
+        # export the current query, only serialized when asked for
+        file_format = st.selectbox('Export Format:', ['CSV', 'Parquet'])
+        if st.button('Prepare Export'):
+            file_name = data_source.lower().replace(' ', '_').replace('-', '_')
+            if file_format == 'Parquet':
+                st.download_button('Download Parquet', data=export_table(table, file_format),
+                                   file_name=f'{file_name}.parquet', mime='application/octet-stream')
+            else:
+                st.download_button('Download CSV', data=export_table(table, file_format),
+                                   file_name=f'{file_name}.csv', mime='text/csv')
 
     elif view == 'Data Visualization':
 
@@ -162,40 +687,30 @@ def main():
         # select a region
         selection = st.selectbox('Select Region:', region, index=idx_ger)
 
-        # iterate over all three dfs and prepare for plot
-        for name, _ in df_dict.items():
-            df_dict[name] = df_dict[name][deaths['Country/Region'] == selection].drop(columns='Country/Region')
-            df_dict[name] = pd.melt(df_dict[name])
-            df_dict[name]['date'] = pd.to_datetime(df_dict[name].variable, infer_datetime_format=True)
-            df_dict[name] = df_dict[name].set_index('date')
-            df_dict[name] = df_dict[name][['value']]
-            df_dict[name].columns = [name]
-
-        df = reduce(lambda a, b: pd.merge(a, b, on='date'), list(df_dict.values()))
-        df['confirmed_active'] = df.confirmed - (df.deaths + df.recovered)
-
-        plot_columns = ['recovered', 'confirmed_active', 'deaths']
-        colors = ['forestgreen', 'gold', 'red']
-
-        color_scale = alt.Scale(domain=plot_columns, range=colors)
-
-        plot_df = pd.melt(df.reset_index(), id_vars=['date'], value_vars=plot_columns)
-
-        # prevent altair from sorting the variables (deaths should be lowest)
-        plot_df['order'] = plot_df['variable'].replace({val: idx for idx, val in enumerate(plot_columns[::-1])})
+        show_projection = st.checkbox('Show Projection of Confirmed Cases')
+        if show_projection:
+            model = st.selectbox('Projection Model:', ['Log-Linear', 'Logistic'])
+            horizon = st.slider('Projected Days', min_value=7, max_value=28, value=14)
 
         # make some space
         st.header('')
 
-        altair_plot = alt.Chart(plot_df.reset_index()).mark_bar().properties(height=300).encode(
-            x=alt.X('date:T', title='Date'),
-            y=alt.Y('sum(value):Q', title='Count', scale=alt.Scale(type='linear')),
-            color=alt.Color('variable:N', title='', scale=color_scale),
-            order='order'
-        )
+        if show_projection:
+            dates, lower, mid, upper, fit_time = project(confirmed, data_version, model, horizon)
+            idx = list(region).index(selection)
+            projection_df = pd.DataFrame({'date': dates, 'lower': lower[idx], 'projection': mid[idx],
+                                          'upper': upper[idx]})
+            performance.text(f'Projection refit of {len(confirmed):,} regions: {fit_time * 1000:.2f} ms')
+        else:
+            model, horizon, projection_df = None, None, None
+
+        chart = region_chart_spec(confirmed, deaths, recovered, data_version, selection, model, horizon,
+                                  projection_df)
+        hit = serve_cached(chart)
 
-        # show plot in streamlit
-        st.altair_chart(altair_plot, use_container_width=True)
+        # show plot in streamlit, the cached page already holds the serialized spec and is sent as is
+        components.html(chart['html'], height=CHART_HEIGHT)
+        report_cached(performance, 'Chart spec', chart, hit)
 
     elif view == 'World Map':
 
@@ -215,52 +730,60 @@ def main():
         info_placeholder.text(f'Data displayed for {date_list[date_index]}')
 
         if data_source == 'Confirmed Cases':
-            map_df = map_digest_format(confirmed_raw, date_list[date_index])
+            points_df = confirmed_raw
         elif data_source == 'COVID-19 Related Deaths':
-            map_df = map_digest_format(deaths_raw, date_list[date_index])
+            points_df = deaths_raw
         else:
-            map_df = map_digest_format(recovered_raw, date_list[date_index])
-
-        map_placeholder.pydeck_chart(pdk.Deck(
-            map_style='mapbox://styles/mapbox/dark-v9',
-            tooltip={'text': '{Combined_Key}: {data_string}'},
-            initial_view_state=pdk.ViewState(
-                latitude=41.1533,
-                longitude=20.1683,
-                zoom=0.5,
-                pitch=0,
-            ),
-            layers=[
-                pdk.Layer(
-                    'HeatmapLayer',
-                    data=map_df,
-                    get_position='[Long, Lat]',
-                    opacity=1.0,
-                    aggregation='"MEAN"',
-                    get_weight='[data]',
-                    radius_pixels=intensity,
-                    threshold=0.002,
-                    pickable=True
-                ),
-                pdk.Layer(
-                    'ScatterplotLayer',
-                    data=map_df,
-                    get_position='[Long, Lat]',
-                    pickable=True,
-                    opacity=0.99,
-                    stroked=True,
-                    filled=True,
-                    radius_scale=20,
-                    radius_min_pixels=20,
-                    radius_max_pixels=100,
-                    line_width_min_pixels=1,
-                    get_radius='exits_radius',
-                    get_fill_color=[0, 0, 0, 0.0],
-                    get_line_color=[0, 0, 0, 0.0],
-                )
-            ],
-        )
-        )
+            points_df = recovered_raw
+
+        # the index only depends on the coordinates, so it is built once per data snapshot
+        index, build_time = build_spatial_index(points_df, data_version, data_source)
+
+        # search the regions on the server, only the matches are sent to the client
+        search = st.text_input('Search Region to Center Map On:')
+        locations = search_locations(points_df, data_version, data_source, search)
+        center = st.selectbox('Center Map On:', ['World'] + locations)
+        if center == 'World':
+            latitude, longitude, zoom, min_zoom = 41.1533, 20.1683, 0.5, 0
+            bounds = -90.0, -180.0, 90.0, 180.0
+        else:
+            center_position = int(np.flatnonzero(points_df['Combined_Key'].to_numpy() == center)[0])
+            center_row = points_df.iloc[center_position]
+            latitude, longitude = float(center_row['Lat']), float(center_row['Long'])
+            zoom = st.slider('Zoom', min_value=1, max_value=10, value=4)
+            min_zoom = zoom
+            bounds = viewport_bounds(latitude, longitude, zoom)
+
+        # only serialize the points within the visible bounds and the columns used by the layers
+        start = time.perf_counter()
+        visible = query_viewport(index, *bounds)
+        query_time = time.perf_counter() - start
+        deck = map_deck(points_df, visible, data_version, data_source, date_list[date_index],
+                        latitude, longitude, zoom, min_zoom, intensity)
+        hit = serve_cached(deck)
+        map_placeholder.pydeck_chart(deck['deck'])
+        if center != 'World':
+            st.text(f'Only regions around {center} are loaded, choose World to see all of them.')
+
+        if center != 'World':
+            st.markdown(f'### Regions near {center}:')
+            start = time.perf_counter()
+            # the centred region is its own nearest point, so ask for one more and drop it
+            nearest, distance = query_nearest(index, latitude, longitude, k=NUM_NEAREST + 1)
+            nearest_time = time.perf_counter() - start
+            others = nearest != center_position
+            nearest, distance = nearest[others][:NUM_NEAREST], distance[others][:NUM_NEAREST]
+            nearby_df = points_df.iloc[nearest][['Combined_Key', date_list[date_index]]].reset_index(drop=True)
+            nearby_df.insert(1, 'Distance (km)', distance.round(1))
+            st.dataframe(nearby_df)
+
+        performance.text(f'Index build: {build_time * 1000:.2f} ms')
+        performance.text(f'Viewport query: {query_time * 1000:.2f} ms ({len(visible):,}/{len(points_df):,} points)')
+        if center != 'World':
+            performance.text(f'Nearest query: {nearest_time * 1000:.2f} ms')
+        report_cached(performance, 'Deck spec', deck, hit)
+
+    performance.text(f'Script run: {(time.perf_counter() - run_start) * 1000:.2f} ms')
 
     st.info(
         """
@@ -272,4 +795,9 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    if '--warm-up' in sys.argv:
+        warm_up()
+    elif '--benchmark' in sys.argv:
+        benchmark()
+    else:
+        main()